@@ -0,0 +1,279 @@
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import interp1d
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import correlate, correlation_lags
+from parse_csv import parse_csv
+from ir_and_red_peaktrough_detection import ir_and_red_peaktrough_detection
+from calculate_bpm import calculate_bpm
+from calculate_spo2 import calculate_spo2
+
+
+def load_reference_log(filepath, reference_fs=1.0, time_column=None):
+    """
+    Load SpO₂ and pulse rate from a reference oximeter (Masimo) CSV export.
+
+    Time is taken before any filtering, so dropout rows (e.g. '---' on probe-off)
+    keep their place on the timeline and come back as NaN in that channel only.
+
+    Parameters:
+    - filepath (str): Path to the reference CSV with 'O2 Saturation' and 'Pulse Rate' columns
+    - reference_fs (float): Sampling rate of the reference log in Hz, used when
+      time_column is not given (default: 1)
+    - time_column (str): Optional timestamp column in the export; if given, time is read
+      from it instead of assuming a fixed sampling rate
+
+    Returns:
+    - ref_time (np.ndarray): Time in seconds from the first row of the log
+    - ref_spo2 (np.ndarray): Reference SpO₂ values, NaN during dropouts
+    - ref_hr (np.ndarray): Reference pulse rate values, NaN during dropouts
+    """
+    ref_df = pd.read_csv(filepath)
+
+    # === Time axis from the raw rows, before dropping anything ===
+    if time_column is not None:
+        timestamps = pd.to_datetime(ref_df[time_column], errors='coerce')
+        ref_df = ref_df[timestamps.notna()].reset_index(drop=True)
+        timestamps = timestamps[timestamps.notna()].reset_index(drop=True)
+        ref_time = (timestamps - timestamps.iloc[0]).dt.total_seconds().to_numpy()
+    else:
+        ref_time = np.arange(len(ref_df)) / reference_fs
+
+    # Non-numeric dropout values become NaN per channel; _to_grid skips them later
+    ref_spo2 = pd.to_numeric(ref_df['O2 Saturation'], errors='coerce').to_numpy(dtype=float)
+    ref_hr = pd.to_numeric(ref_df['Pulse Rate'], errors='coerce').to_numpy(dtype=float)
+    return ref_time, ref_spo2, ref_hr
+
+
+def load_device_ppg(filepath):
+    """
+    Load raw PPG from a device CSV, either a plain 'Time Stamp, Red Light, IR' export
+    or the tagged ECG/PPG/GSR firmware log handled by parse_csv.
+
+    Returns:
+    - t_raw (np.ndarray): Time in seconds from the first PPG sample
+    - red_raw (np.ndarray): Raw red light values
+    - ir_raw (np.ndarray): Raw IR values
+    """
+    header = pd.read_csv(filepath, nrows=0).columns.str.strip()
+    if {'Time Stamp', 'Red Light', 'IR'}.issubset(header):
+        df = pd.read_csv(filepath)
+        df.columns = df.columns.str.strip()
+        time_ms = df['Time Stamp'].astype(float)
+        t_raw = ((time_ms - time_ms.iloc[0]) / 1000.0).to_numpy()
+        return t_raw, df['Red Light'].to_numpy(), df['IR'].to_numpy()
+
+    parsed_data = parse_csv(filepath)
+    return parsed_data['t_raw'], parsed_data['red_raw'], parsed_data['ir_raw']
+
+
+def device_spo2_and_hr(t_raw, red_raw, ir_raw, desired_fs=250, sigma=6,
+                       red_prominence=200, ir_prominence=350):
+    """
+    Run the PPG pipeline (resample, smooth, peak detection, SpO₂ and BPM) on raw data.
+
+    Returns:
+    - spo2_time (np.ndarray), spo2 (np.ndarray): Smoothed SpO₂ series
+    - bpm_time (np.ndarray), bpm (np.ndarray): Smoothed heart rate series from IR peaks
+    """
+    # === Interpolate to uniform sampling and smooth ===
+    t_uniform = np.arange(t_raw[0], t_raw[-1], 1 / desired_fs)
+    red = interp1d(t_raw, red_raw, kind='linear', fill_value="extrapolate")(t_uniform)
+    ir = interp1d(t_raw, ir_raw, kind='linear', fill_value="extrapolate")(t_uniform)
+    red_smoothed = gaussian_filter1d(red, sigma=sigma)
+    ir_smoothed = gaussian_filter1d(ir, sigma=sigma)
+
+    # === Peak detection, HR and SpO₂ ===
+    peaks = ir_and_red_peaktrough_detection(red_smoothed, ir_smoothed,
+                                            red_prominence=red_prominence, ir_prominence=ir_prominence)
+    bpm_time, _, bpm_smooth = calculate_bpm(peaks['ir_peaks_idx'], t_uniform)
+    spo2_df, _ = calculate_spo2(peaks['ir_peaks_idx'], peaks['red_peaks_idx'], red, ir, t_uniform, desired_fs)
+
+    return spo2_df['Time'].to_numpy(), spo2_df['SpO2'].to_numpy(), bpm_time, bpm_smooth
+
+
+def _to_grid(grid, time, values):
+    # Linear interpolation onto the grid, NaN outside the series' own span
+    valid = ~np.isnan(values)
+    if valid.sum() < 2:
+        return np.full(len(grid), np.nan)
+    resampled = np.interp(grid, time[valid], values[valid], left=np.nan, right=np.nan)
+
+    # Do not bridge dropouts: grid points bracketed by a NaN sample stay NaN
+    right = np.clip(np.searchsorted(time, grid, side='right'), 0, len(time) - 1)
+    left = np.clip(right - 1, 0, len(time) - 1)
+    on_sample = time[left] == grid
+    in_gap = ~valid[left] | (~valid[right] & ~on_sample)
+    resampled[in_gap] = np.nan
+    return resampled
+
+
+def _zscore(values):
+    # Standardize ignoring NaNs, then zero-fill so gaps do not contribute to the correlation
+    std = np.nanstd(values)
+    if not np.isfinite(std) or std == 0:
+        return np.zeros(len(values))
+    return np.nan_to_num((values - np.nanmean(values)) / std)
+
+
+def estimate_offset(device_series, reference_series, grid_fs=1.0, max_lag_s=60):
+    """
+    Estimate the time offset between device and reference series by FFT cross-correlation.
+
+    Each channel (e.g. SpO₂ and HR) is resampled to a uniform grid and z-scored, and the
+    cross-correlations of all channels are summed so they agree on one clock offset.
+
+    Parameters:
+    - device_series (list of (time, values)): Device channels
+    - reference_series (list of (time, values)): Reference channels, in the same order
+    - grid_fs (float): Resampling rate for the correlation in Hz (default: 1)
+    - max_lag_s (float): Largest offset searched, in seconds (default: 60)
+
+    Returns:
+    - offset (float): Seconds to add to reference times to align them with the device
+    """
+    dt = 1 / grid_fs
+    dev_start = min(t[0] for t, _ in device_series)
+    dev_end = max(t[-1] for t, _ in device_series)
+    ref_start = min(t[0] for t, _ in reference_series)
+    ref_end = max(t[-1] for t, _ in reference_series)
+    dev_grid = np.arange(dev_start, dev_end + dt, dt)
+    ref_grid = np.arange(ref_start, ref_end + dt, dt)
+
+    # === Sum per-channel cross-correlations ===
+    xcorr = np.zeros(len(dev_grid) + len(ref_grid) - 1)
+    for (dev_t, dev_v), (ref_t, ref_v) in zip(device_series, reference_series):
+        dev = _zscore(_to_grid(dev_grid, np.asarray(dev_t), np.asarray(dev_v, dtype=float)))
+        ref = _zscore(_to_grid(ref_grid, np.asarray(ref_t), np.asarray(ref_v, dtype=float)))
+        xcorr += correlate(dev, ref, mode='full', method='fft')
+
+    # === Restrict to the allowed lag window and pick the peak ===
+    # A peak at lag k means dev_grid[l] lines up with ref_grid[l - k]
+    lags = correlation_lags(len(dev_grid), len(ref_grid), mode='full')
+    offsets = dev_start - ref_start + lags * dt
+    in_window = np.abs(offsets) <= max_lag_s
+    if not in_window.any():
+        return 0.0
+    best = np.argmax(np.where(in_window, xcorr, -np.inf))
+    return float(offsets[best])
+
+
+def agreement_stats(device_time, device_values, ref_time, ref_values, grid_fs=1.0):
+    """
+    Resample aligned device and reference series to a common grid and compute agreement.
+
+    Returns:
+    - stats (dict): n, bias, sd, loa_lower, loa_upper (bias ± 1.96 SD), mae and arms,
+      all computed on device minus reference
+    """
+    start = max(device_time[0], ref_time[0])
+    end = min(device_time[-1], ref_time[-1])
+    grid = np.arange(start, end, 1 / grid_fs) if end > start else np.array([])
+
+    dev = _to_grid(grid, np.asarray(device_time), np.asarray(device_values, dtype=float))
+    ref = _to_grid(grid, np.asarray(ref_time), np.asarray(ref_values, dtype=float))
+    diff = dev - ref
+    diff = diff[~np.isnan(diff)]
+
+    if len(diff) < 2:
+        return {'n': len(diff), 'bias': np.nan, 'sd': np.nan, 'loa_lower': np.nan,
+                'loa_upper': np.nan, 'mae': np.nan, 'arms': np.nan}
+
+    bias = np.mean(diff)
+    sd = np.std(diff, ddof=1)
+    return {
+        'n': len(diff),
+        'bias': bias,
+        'sd': sd,
+        'loa_lower': bias - 1.96 * sd,
+        'loa_upper': bias + 1.96 * sd,
+        'mae': np.mean(np.abs(diff)),
+        'arms': np.sqrt(np.mean(diff ** 2))
+    }
+
+
+def validate_trial(device_csv, reference_csv, reference_fs=1.0, time_column=None,
+                   grid_fs=1.0, max_lag_s=60):
+    """
+    Align one trial's device SpO₂/HR with its reference log and compute agreement statistics.
+
+    Returns:
+    - result (dict): offset_s plus spo2_* and hr_* agreement statistics
+    """
+    t_raw, red_raw, ir_raw = load_device_ppg(device_csv)
+    spo2_time, spo2, bpm_time, bpm = device_spo2_and_hr(t_raw, red_raw, ir_raw)
+    ref_time, ref_spo2, ref_hr = load_reference_log(reference_csv, reference_fs, time_column)
+
+    offset = estimate_offset([(spo2_time, spo2), (bpm_time, bpm)],
+                             [(ref_time, ref_spo2), (ref_time, ref_hr)],
+                             grid_fs=grid_fs, max_lag_s=max_lag_s)
+    ref_time_shifted = ref_time + offset
+
+    result = {'offset_s': offset}
+    for key, value in agreement_stats(spo2_time, spo2, ref_time_shifted, ref_spo2, grid_fs).items():
+        result[f'spo2_{key}'] = value
+    for key, value in agreement_stats(bpm_time, bpm, ref_time_shifted, ref_hr, grid_fs).items():
+        result[f'hr_{key}'] = value
+    return result
+
+
+def _validate_trial_dir(args):
+    # Worker for validate_trial_directories; failures are recorded rather than aborting the batch
+    trial_dir, device_pattern, reference_pattern, kwargs = args
+    row = {'trial': os.path.basename(os.path.normpath(trial_dir))}
+    device_files = sorted(glob.glob(os.path.join(trial_dir, device_pattern)))
+    reference_files = sorted(glob.glob(os.path.join(trial_dir, reference_pattern)))
+    if not device_files or not reference_files:
+        row['error'] = 'missing device or reference CSV'
+        return row
+
+    row['device_csv'] = device_files[0]
+    row['reference_csv'] = reference_files[0]
+    try:
+        row.update(validate_trial(device_files[0], reference_files[0], **kwargs))
+    except Exception as exc:
+        row['error'] = repr(exc)
+    return row
+
+
+def validate_trial_directories(root_dir, report_path=None,
+                               device_pattern='*masimocomp*.csv',
+                               reference_pattern='*masimodevice*.csv',
+                               max_workers=None, **kwargs):
+    """
+    Validate every trial directory under root_dir in parallel and collect one report.
+
+    Each subdirectory of root_dir is one trial holding a device CSV and a reference CSV
+    matched by device_pattern and reference_pattern. Extra keyword arguments are passed
+    to validate_trial.
+
+    Parameters:
+    - root_dir (str): Directory containing one subdirectory per trial
+    - report_path (str): If given, the report is written there as CSV
+    - max_workers (int): Number of worker processes (default: os.cpu_count())
+
+    Returns:
+    - report (pd.DataFrame): One row per trial
+
+    Raises:
+    - FileNotFoundError: If root_dir does not exist
+    - ValueError: If root_dir has no trial subdirectories
+    """
+    if not os.path.isdir(root_dir):
+        raise FileNotFoundError(f"Validation directory not found: {root_dir}")
+    trial_dirs = sorted(d for d in glob.glob(os.path.join(root_dir, '*')) if os.path.isdir(d))
+    if not trial_dirs:
+        raise ValueError(f"No trial subdirectories found in {root_dir}")
+    jobs = [(d, device_pattern, reference_pattern, kwargs) for d in trial_dirs]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(executor.map(_validate_trial_dir, jobs))
+
+    report = pd.DataFrame(rows)
+    if report_path:
+        report.to_csv(report_path, index=False)
+    return report
@@ -0,0 +1,32 @@
+import numpy as np
+from validate_against_reference import validate_trial_directories
+
+# Each subdirectory is one trial with a *masimocomp*.csv (our device) and a *masimodevice*.csv (Masimo)
+validation_root = 'ali_validation'
+report_path = 'masimo_validation_report.csv'
+
+if __name__ == '__main__':
+    # Offsets are found per trial by FFT cross-correlation, no manual masimo_offset needed
+    report = validate_trial_directories(validation_root, report_path=report_path, max_lag_s=60)
+
+    # === Print Results ===
+    print(report.to_string(index=False))
+
+    ok = report[report['error'].isna()] if 'error' in report else report
+    print(f"\nTrials validated: {len(ok)} of {len(report)}")
+    for name in ['spo2', 'hr']:
+        # Nothing to pool if no trial produced statistics
+        if ok.empty or f'{name}_bias' not in ok:
+            continue
+        diff_n = ok[f'{name}_n'].to_numpy()
+        bias = ok[f'{name}_bias'].to_numpy()
+        arms = ok[f'{name}_arms'].to_numpy()
+        valid = ~np.isnan(bias)
+        if not valid.any():
+            continue
+        # Pool per-trial statistics weighted by number of paired samples
+        pooled_bias = np.average(bias[valid], weights=diff_n[valid])
+        pooled_arms = np.sqrt(np.average(arms[valid] ** 2, weights=diff_n[valid]))
+        print(f"{name.upper()} pooled bias: {pooled_bias:.2f}, pooled ARMS: {pooled_arms:.2f}")
+
+    print(f"Report written to {report_path}")